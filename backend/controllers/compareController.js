@@ -3,8 +3,8 @@ import fs from 'fs/promises';
 import fsSync from 'fs';
 import path from 'path';
 import { fileURLToPath } from 'url';
-import ffmpeg from 'fluent-ffmpeg';
 import progressTracker from '../utils/progressTracker.js';
+import probeCache from '../utils/probeCache.js';
 
 const __filename = fileURLToPath(import.meta.url);
 const __dirname = path.dirname(__filename);
@@ -22,6 +22,64 @@ try {
 // Store comparison results (in production, use a database)
 const comparisonResults = new Map();
 
+// Segment pairs probed at once during batch validation (two ffprobe runs each)
+const VALIDATION_CONCURRENCY = 4;
+
+// Batches currently running, keyed by their segment pairs, so a resubmitted
+// batch doesn't repeat the same Gemini analysis while the first is in flight
+const activeBatches = new Map();
+
+// Gemini model shared across requests, created lazily so .env is loaded first
+const GEMINI_MODEL = 'gemini-3-pro-preview';
+let geminiModel = null;
+
+function getGeminiModel() {
+  if (!geminiModel) {
+    const genAI = new GoogleGenerativeAI(process.env.GEMINI_API_KEY);
+    geminiModel = genAI.getGenerativeModel({ model: GEMINI_MODEL });
+  }
+  return geminiModel;
+}
+
+// Retry settings for transient Gemini failures (rate limits, overload)
+const GEMINI_MAX_ATTEMPTS = 3;
+const GEMINI_RETRYABLE_STATUSES = new Set([429, 500, 503]);
+const GEMINI_BASE_RETRY_DELAY_MS = 2000;
+// Longest server-requested wait we'll sleep through while the client's request is open
+const GEMINI_MAX_RETRY_DELAY_MS = 30000;
+
+// Delay requested by the API via RetryInfo (e.g. retryDelay: "17s"), if any
+function getRetryDelayMs(error) {
+  const retryInfo = error.errorDetails?.find(detail => detail['@type']?.endsWith('RetryInfo'));
+  const seconds = parseFloat(retryInfo?.retryDelay);
+  return Number.isFinite(seconds) ? seconds * 1000 : null;
+}
+
+// Call Gemini, retrying transient errors with jittered exponential backoff
+async function generateContentWithRetry(model, parts) {
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await model.generateContent(parts);
+    } catch (error) {
+      if (attempt >= GEMINI_MAX_ATTEMPTS || !GEMINI_RETRYABLE_STATUSES.has(error.status)) {
+        throw error;
+      }
+
+      // Honor the server's RetryInfo unless it asks for longer than we can hold
+      // the request open (e.g. quota exhaustion); then fail instead of sleeping
+      const serverDelayMs = getRetryDelayMs(error);
+      if (serverDelayMs !== null && serverDelayMs > GEMINI_MAX_RETRY_DELAY_MS) {
+        throw error;
+      }
+
+      const backoffMs = GEMINI_BASE_RETRY_DELAY_MS * 2 ** (attempt - 1) * (0.5 + Math.random());
+      const delayMs = serverDelayMs ?? backoffMs;
+      console.log(`⚠️  Gemini returned ${error.status}, retrying in ${(delayMs / 1000).toFixed(1)}s (attempt ${attempt + 1}/${GEMINI_MAX_ATTEMPTS})`);
+      await new Promise(resolve => setTimeout(resolve, delayMs));
+    }
+  }
+}
+
 // Log comparison results to file
 async function logComparison(segmentIndex, instructorVideo, userVideo, prompt, response, duration) {
   const timestamp = new Date().toISOString();
@@ -66,66 +124,8 @@ async function fileToGenerativePart(filePath, mimeType) {
   };
 }
 
-// Compare two video segments
-export const compareVideos = async (req, res) => {
-  try {
-    const { instructorVideo, userVideo, segmentIndex } = req.body;
-
-    if (!instructorVideo || !userVideo) {
-      return res.status(400).json({ error: 'Both instructor and user videos are required' });
-    }
-
-    if (!process.env.GEMINI_API_KEY) {
-      return res.status(500).json({
-        error: 'Gemini API key not configured. Please add GEMINI_API_KEY to your .env file'
-      });
-    }
-
-    const instructorPath = path.join(outputsDir, instructorVideo);
-    const userPath = path.join(outputsDir, userVideo);
-
-    // Verify files exist
-    await fs.access(instructorPath);
-    await fs.access(userPath);
-
-    // Validate segment duration (20 minute maximum = 1200 seconds)
-    const getDuration = (filePath) => {
-      return new Promise((resolve, reject) => {
-        ffmpeg.ffprobe(filePath, (err, metadata) => {
-          if (err) reject(err);
-          else resolve(metadata.format.duration);
-        });
-      });
-    };
-
-    const instructorDuration = await getDuration(instructorPath);
-    const userDuration = await getDuration(userPath);
-
-    if (instructorDuration > 1200) {
-      return res.status(400).json({
-        error: `Instructor segment is ${(instructorDuration / 60).toFixed(1)} minutes. Maximum allowed is 20 minutes per segment.`
-      });
-    }
-
-    if (userDuration > 1200) {
-      return res.status(400).json({
-        error: `User segment is ${(userDuration / 60).toFixed(1)} minutes. Maximum allowed is 20 minutes per segment.`
-      });
-    }
-
-    // Convert videos to inline data (base64)
-    const instructorPart = await fileToGenerativePart(instructorPath, 'video/mp4');
-    const userPart = await fileToGenerativePart(userPath, 'video/mp4');
-
-    // Initialize Gemini AI (do this here to ensure .env is loaded)
-    const genAI = new GoogleGenerativeAI(process.env.GEMINI_API_KEY);
-
-    // Create the model - Using latest Gemini 3 Pro (as of Dec 2024)
-    const model = genAI.getGenerativeModel({ model: 'gemini-3-pro-preview' });
-    console.log(`🤖 Using model: gemini-3-pro-preview`);
-
-    // Generate comparison
-    const prompt = `You are an expert HIIT workout coach analyzing video submissions.
+// Comparison prompt sent with every segment pair (built once at load time)
+const COMPARISON_PROMPT = `You are an expert HIIT workout coach analyzing video submissions.
 
 Compare these two workout videos:
 1. Instructor Video (reference)
@@ -178,58 +178,115 @@ Format your response as JSON with this structure:
   ]
 }`;
 
-    console.log(`⏳ Sending segment ${segmentIndex || 1} to Gemini 3 Pro for analysis...`);
-    console.log(`   📹 Instructor: ${instructorVideo}`);
-    console.log(`   📹 User: ${userVideo}`);
-    
-    const startTime = Date.now();
-    
-    const result = await model.generateContent([
-      instructorPart,
-      userPart,
-      { text: prompt }
-    ]);
+// Run the Gemini analysis for one already-validated segment pair and store the result
+async function analyzeSegmentPair(instructorVideo, userVideo, segmentIndex) {
+  const instructorPath = path.join(outputsDir, instructorVideo);
+  const userPath = path.join(outputsDir, userVideo);
 
-    const response = result.response.text();
-    const duration = Date.now() - startTime;
-    
-    console.log(`✅ Segment ${segmentIndex || 1} analysis complete in ${(duration / 1000).toFixed(1)}s`);
+  // Convert videos to inline data (base64)
+  const [instructorPart, userPart] = await Promise.all([
+    fileToGenerativePart(instructorPath, 'video/mp4'),
+    fileToGenerativePart(userPath, 'video/mp4')
+  ]);
 
-    // Log the full response to file
-    await logComparison(segmentIndex || 1, instructorVideo, userVideo, prompt, response, duration);
+  // Reuse the shared model - Using latest Gemini 3 Pro (as of Dec 2024)
+  const model = getGeminiModel();
+  console.log(`🤖 Using model: ${GEMINI_MODEL}`);
 
-    // Parse the JSON response
-    let comparisonData;
-    try {
-      // Extract JSON from markdown code blocks if present
-      const jsonMatch = response.match(/```json\n([\s\S]*?)\n```/) || response.match(/\{[\s\S]*\}/);
-      const jsonText = jsonMatch ? (jsonMatch[1] || jsonMatch[0]) : response;
-      comparisonData = JSON.parse(jsonText);
-      console.log(`   📊 Match: ${comparisonData.matchPercentage}% | Grade: ${comparisonData.overallScore}`);
-    } catch (parseError) {
-      console.error('Failed to parse Gemini response:', response);
-      comparisonData = {
-        matchPercentage: 0,
-        overallScore: 'N/A',
-        strengths: [],
-        improvements: [],
-        analysis: response,
-        timestamps: []
-      };
-    }
+  console.log(`⏳ Sending segment ${segmentIndex || 1} to Gemini 3 Pro for analysis...`);
+  console.log(`   📹 Instructor: ${instructorVideo}`);
+  console.log(`   📹 User: ${userVideo}`);
+  
+  const startTime = performance.now();
+  
+  const result = await generateContentWithRetry(model, [
+    instructorPart,
+    userPart,
+    { text: COMPARISON_PROMPT }
+  ]);
+
+  const response = result.response.text();
+  const duration = Math.round(performance.now() - startTime);
+  
+  console.log(`✅ Segment ${segmentIndex || 1} analysis complete in ${(duration / 1000).toFixed(1)}s`);
 
-    // Store result
-    const resultId = `${Date.now()}-${Math.random().toString(36).substr(2, 9)}`;
-    const fullResult = {
-      id: resultId,
-      segmentIndex: segmentIndex || 0,
-      instructorVideo,
-      userVideo,
-      timestamp: new Date().toISOString(),
-      ...comparisonData
+  // Log the full response to file
+  await logComparison(segmentIndex || 1, instructorVideo, userVideo, COMPARISON_PROMPT, response, duration);
+
+  // Parse the JSON response
+  let comparisonData;
+  try {
+    // Extract JSON from markdown code blocks if present
+    const jsonMatch = response.match(/```json\n([\s\S]*?)\n```/) || response.match(/\{[\s\S]*\}/);
+    const jsonText = jsonMatch ? (jsonMatch[1] || jsonMatch[0]) : response;
+    comparisonData = JSON.parse(jsonText);
+    console.log(`   📊 Match: ${comparisonData.matchPercentage}% | Grade: ${comparisonData.overallScore}`);
+  } catch (parseError) {
+    console.error('Failed to parse Gemini response:', response);
+    comparisonData = {
+      matchPercentage: 0,
+      overallScore: 'N/A',
+      strengths: [],
+      improvements: [],
+      analysis: response,
+      timestamps: []
     };
+  }
 
-    comparisonResults.set(resultId, fullResult);
+  // Store result
+  const resultId = `${Date.now()}-${Math.random().toString(36).substr(2, 9)}`;
+  const fullResult = {
+    id: resultId,
+    segmentIndex: segmentIndex || 0,
+    instructorVideo,
+    userVideo,
+    timestamp: new Date().toISOString(),
+    ...comparisonData
+  };
+
+  comparisonResults.set(resultId, fullResult);
+
+  return fullResult;
+}
+
+// Compare two video segments
+export const compareVideos = async (req, res) => {
+  try {
+    const { instructorVideo, userVideo, segmentIndex } = req.body;
+
+    if (!instructorVideo || !userVideo) {
+      return res.status(400).json({ error: 'Both instructor and user videos are required' });
+    }
+
+    if (!process.env.GEMINI_API_KEY) {
+      return res.status(500).json({
+        error: 'Gemini API key not configured. Please add GEMINI_API_KEY to your .env file'
+      });
+    }
+
+    const instructorPath = path.join(outputsDir, instructorVideo);
+    const userPath = path.join(outputsDir, userVideo);
+
+    // Validate segment duration (20 minute maximum = 1200 seconds)
+    // probeCache stats each file first, so a missing file rejects here
+    const [instructorDuration, userDuration] = await Promise.all([
+      probeCache.getDuration(instructorPath),
+      probeCache.getDuration(userPath)
+    ]);
+
+    if (instructorDuration > 1200) {
+      return res.status(400).json({
+        error: `Instructor segment is ${(instructorDuration / 60).toFixed(1)} minutes. Maximum allowed is 20 minutes per segment.`
+      });
+    }
+
+    if (userDuration > 1200) {
+      return res.status(400).json({
+        error: `User segment is ${(userDuration / 60).toFixed(1)} minutes. Maximum allowed is 20 minutes per segment.`
+      });
+    }
+
+    const fullResult = await analyzeSegmentPair(instructorVideo, userVideo, segmentIndex);
 
     res.json(fullResult);
 
@@ -244,6 +301,8 @@ Format your response as JSON with this structure:
 
 // Batch compare multiple segment pairs (with progress tracking)
 export const batchCompare = async (req, res) => {
+  let batchKey = null;
+
   try {
     const { comparisons } = req.body;
 
@@ -251,9 +310,26 @@ export const batchCompare = async (req, res) => {
       return res.status(400).json({ error: 'Comparisons array is required' });
     }
 
+    if (!process.env.GEMINI_API_KEY) {
+      return res.status(500).json({
+        error: 'Gemini API key not configured. Please add GEMINI_API_KEY to your .env file'
+      });
+    }
+
+    // Reject a duplicate of a batch that is still being analyzed
+    const pairKey = comparisons.map(c => `${c.instructorVideo}|${c.userVideo}`).join(',');
+    if (activeBatches.has(pairKey)) {
+      return res.status(409).json({
+        error: 'An identical batch comparison is already running',
+        jobId: activeBatches.get(pairKey)
+      });
+    }
+
     // Create a job ID for progress tracking
     const jobId = `compare_${Date.now()}`;
     progressTracker.createJob(jobId, 100);
+    activeBatches.set(pairKey, jobId);
+    batchKey = pairKey;
     
     console.log(`\n${'='.repeat(60)}`);
     console.log(`🚀 Starting batch comparison: ${comparisons.length} segments`);
@@ -261,50 +337,52 @@ export const batchCompare = async (req, res) => {
     console.log(`${'='.repeat(60)}\n`);
 
     // Pre-validate all segments before processing
-    const validationErrors = [];
-    for (let i = 0; i < comparisons.length; i++) {
-      const { instructorVideo, userVideo } = comparisons[i];
+    const validatePair = async ({ instructorVideo, userVideo }, i) => {
+      const errors = [];
       const instructorPath = path.join(outputsDir, instructorVideo);
       const userPath = path.join(outputsDir, userVideo);
 
       try {
-        // Check if files exist
-        await fs.access(instructorPath);
-        await fs.access(userPath);
-
-        // Check durations
-        const getDuration = (filePath) => {
-          return new Promise((resolve, reject) => {
-            ffmpeg.ffprobe(filePath, (err, metadata) => {
-              if (err) reject(err);
-              else resolve(metadata.format.duration);
-            });
-          });
-        };
-
-        const instructorDuration = await getDuration(instructorPath);
-        const userDuration = await getDuration(userPath);
+        // Check durations (cached so re-running the same pairs skips ffprobe);
+        // a missing file surfaces as an ENOENT from probeCache's stat
+        const [instructorDuration, userDuration] = await Promise.all([
+          probeCache.getDuration(instructorPath),
+          probeCache.getDuration(userPath)
+        ]);
 
         if (instructorDuration > 1200) {
-          validationErrors.push({
+          errors.push({
             segmentIndex: i + 1,
             error: `Instructor segment ${i + 1} is ${(instructorDuration / 60).toFixed(1)} minutes (exceeds 20 min limit)`
           });
         }
 
         if (userDuration > 1200) {
-          validationErrors.push({
+          errors.push({
             segmentIndex: i + 1,
             error: `User segment ${i + 1} is ${(userDuration / 60).toFixed(1)} minutes (exceeds 20 min limit)`
           });
         }
       } catch (error) {
-        validationErrors.push({
+        errors.push({
           segmentIndex: i + 1,
           error: `Error validating segment ${i + 1}: ${error.message}`
         });
       }
+
+      return errors;
+    };
+
+    // Probe pairs in small concurrent chunks to bound the number of ffprobe
+    // processes; results stay in pair order
+    const validationResults = [];
+    for (let start = 0; start < comparisons.length; start += VALIDATION_CONCURRENCY) {
+      const chunk = comparisons.slice(start, start + VALIDATION_CONCURRENCY);
+      validationResults.push(...await Promise.all(
+        chunk.map((pair, offset) => validatePair(pair, start + offset))
+      ));
     }
+    const validationErrors = validationResults.flat();
 
     // If validation errors exist, return them without processing
     if (validationErrors.length > 0) {
@@ -335,26 +413,8 @@ export const batchCompare = async (req, res) => {
       });
 
       try {
-        // Create a mock request object for compareVideos
-        const mockReq = {
-          body: {
-            instructorVideo,
-            userVideo,
-            segmentIndex: segmentNum
-          }
-        };
-
-        // Use a promise to handle the comparison
-        const result = await new Promise((resolve, reject) => {
-          const mockRes = {
-            json: (data) => resolve(data),
-            status: (code) => ({
-              json: (data) => reject({ code, ...data })
-            })
-          };
-
-          compareVideos(mockReq, mockRes);
-        });
+        // Pairs were validated above, so go straight to the analysis
+        const result = await analyzeSegmentPair(instructorVideo, userVideo, segmentNum);
 
         results.push(result);
         
@@ -366,10 +426,10 @@ export const batchCompare = async (req, res) => {
         });
         
       } catch (error) {
-        console.error(`❌ Segment ${segmentNum} failed:`, error.error || error.message);
+        console.error(`❌ Segment ${segmentNum} failed:`, error.message);
         errors.push({
           segmentIndex: segmentNum,
-          error: error.error || error.message
+          error: error.message
         });
       }
     }
@@ -409,6 +469,8 @@ export const batchCompare = async (req, res) => {
       error: 'Failed to perform batch comparison',
       details: error.message
     });
+  } finally {
+    if (batchKey) activeBatches.delete(batchKey);
   }
 };
 
@@ -5,6 +5,7 @@ import fs from 'fs/promises';
 import fsSync from 'fs';
 import { spawn, execSync } from 'child_process';
 import progressTracker from '../utils/progressTracker.js';
+import probeCache from '../utils/probeCache.js';
 
 const __filename = fileURLToPath(import.meta.url);
 const __dirname = path.dirname(__filename);
@@ -35,6 +36,24 @@ console.log('Using yt-dlp at:', YT_DLP_PATH);
 
 // fluent-ffmpeg will use system ffmpeg if available
 
+// Patterns used on every request / yt-dlp output line, compiled once
+const YOUTUBE_URL_REGEX = /^(https?:\/\/)?(www\.)?(youtube\.com|youtu\.be)\/.+/;
+const YTDLP_DOWNLOAD_REGEX = /\[download\]\s+(\d+\.?\d*)%\s+of\s+([\d.]+)(\w+)\s+at\s+([\d.]+)(\w+\/s)/;
+const YTDLP_PERCENT_REGEX = /\[download\]\s+(\d+\.?\d*)%/;
+const YTDLP_ETA_REGEX = /ETA\s+(\d+):(\d+)/;
+const FFMPEG_TIME_REGEX = /time=(\d+):(\d+):(\d+)/;
+const FFMPEG_FRAME_REGEX = /frame=\s*(\d+)/;
+const FFMPEG_TIMEMARK_REGEX = /(\d+):(\d+):(\d+(?:\.\d+)?)/;
+const OUTPUT_LINE_SPLIT_REGEX = /\r?\n|\r/;
+const YTDLP_ALERT_REGEX = /\b(ERROR|WARNING)\b/;
+
+// yt-dlp format selectors by quality preset
+const YTDLP_QUALITY_FORMATS = {
+  fast: 'bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480][ext=mp4]/best',
+  balanced: 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]/best',
+  best: 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+};
+
 const uploadsDir = path.join(__dirname, '..', '..', 'uploads');
 const outputsDir = path.join(__dirname, '..', '..', 'outputs');
 
@@ -127,7 +146,7 @@ export const getVideoInfo = (req, res) => {
       bitRate: metadata.format.bit_rate,
       width: videoStream?.width,
       height: videoStream?.height,
-      fps: eval(videoStream?.r_frame_rate),
+      fps: parseFrameRate(videoStream?.r_frame_rate),
       format: metadata.format.format_name
     });
   });
@@ -256,12 +275,8 @@ async function processSplitAsync(jobId, videoPath, segments) {
             if (progress.percent) {
               intraSegmentPercent = progress.percent;
             } else if (progress.timemark && segment.duration > 0) {
-              // Parse timemark (format: "00:01:30.00")
-              const timeMatch = progress.timemark.match(/(\d+):(\d+):(\d+)/);
-              if (timeMatch) {
-                const processedSeconds = parseInt(timeMatch[1]) * 3600 + 
-                                         parseInt(timeMatch[2]) * 60 + 
-                                         parseInt(timeMatch[3]);
+              const processedSeconds = parseTimemark(progress.timemark);
+              if (processedSeconds !== null) {
                 intraSegmentPercent = (processedSeconds / segment.duration) * 100;
               }
             }
@@ -318,14 +333,17 @@ async function processSplitAsync(jobId, videoPath, segments) {
 // List all output segments with metadata and grouping
 export const listOutputs = async (req, res) => {
   try {
-    const files = await fs.readdir(outputsDir);
+    const files = (await fs.readdir(outputsDir)).filter(f => f.endsWith('.mp4'));
     const outputs = [];
 
-    for (const filename of files) {
-      if (!filename.endsWith('.mp4')) continue;
+    // Stat all segment files in one concurrent batch instead of one per iteration
+    const allStats = await Promise.all(
+      files.map(filename => fs.stat(path.join(outputsDir, filename)))
+    );
 
-      const filePath = path.join(outputsDir, filename);
-      const stats = await fs.stat(filePath);
+    for (let i = 0; i < files.length; i++) {
+      const filename = files[i];
+      const stats = allStats[i];
 
       // Extract batch info from filename patterns like:
       // youtube_instructor_seg_01_1703069234.mp4
@@ -405,6 +423,7 @@ export const deleteOutputs = async (req, res) => {
       try {
         const filePath = path.join(outputsDir, filename);
         await fs.unlink(filePath);
+        probeCache.invalidate(filePath);
         deletedCount++;
       } catch (err) {
         errors.push({ filename, error: err.message });
@@ -483,7 +502,7 @@ async function processTrimAsync(jobId, videoPath, trimStart, trimEnd, outputFile
     });
 
     const videoStream = metadata.streams.find(s => s.codec_type === 'video');
-    const fps = eval(videoStream?.r_frame_rate) || 30;
+    const fps = parseFrameRate(videoStream?.r_frame_rate) || 30;
     const totalFrames = Math.floor(duration * fps);
 
     progressTracker.updateProgress(jobId, {
@@ -525,25 +544,18 @@ async function processTrimAsync(jobId, videoPath, trimStart, trimEnd, outputFile
           
           // Also use time-based progress if available
           if (progress.timemark && duration > 0) {
-            const timeMatch = progress.timemark.match(/(\d+):(\d+):(\d+\.\d+)/);
-            if (timeMatch) {
-              const hours = parseInt(timeMatch[1]);
-              const minutes = parseInt(timeMatch[2]);
-              const seconds = parseFloat(timeMatch[3]);
-              const currentTime = hours * 3600 + minutes * 60 + seconds;
+            const currentTime = parseTimemark(progress.timemark);
+            if (currentTime !== null && currentTime > processedTime) {
+              processedTime = currentTime;
+              const timePercent = Math.min(95, 10 + (currentTime / duration) * 85);
               
-              if (currentTime > processedTime) {
-                processedTime = currentTime;
-                const timePercent = Math.min(95, 10 + (currentTime / duration) * 85);
-                
-                if (timePercent > lastProgress) {
-                  lastProgress = timePercent;
-                  progressTracker.updateProgress(jobId, {
-                    progress: Math.round(timePercent),
-                    phase: 'trim',
-                    message: `Trimming video (${Math.round(timePercent)}%)`
-                  });
-                }
+              if (timePercent > lastProgress) {
+                lastProgress = timePercent;
+                progressTracker.updateProgress(jobId, {
+                  progress: Math.round(timePercent),
+                  phase: 'trim',
+                  message: `Trimming video (${Math.round(timePercent)}%)`
+                });
               }
             }
           }
@@ -610,8 +622,7 @@ export const downloadYouTubeVideo = async (req, res) => {
     }
 
     // Validate YouTube URL
-    const youtubeRegex = /^(https?:\/\/)?(www\.)?(youtube\.com|youtu\.be)\/.+/;
-    if (!youtubeRegex.test(url)) {
+    if (!YOUTUBE_URL_REGEX.test(url)) {
       return res.status(400).json({ error: 'Invalid YouTube URL' });
     }
 
@@ -665,16 +676,9 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
     const outputFilename = `youtube_${timestamp}.mp4`;
     const outputPath = path.join(uploadsDir, outputFilename);
 
-    // Quality format selection
-    const qualityFormats = {
-      fast: 'bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480][ext=mp4]/best',
-      balanced: 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]/best',
-      best: 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-    };
-
     // Build yt-dlp options
     const options = {
-      format: qualityFormats[quality] || qualityFormats.balanced,
+      format: YTDLP_QUALITY_FORMATS[quality] || YTDLP_QUALITY_FORMATS.balanced,
       output: outputPath,
       mergeOutputFormat: 'mp4',
       noPlaylist: true,
@@ -728,7 +732,7 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
 
       const parseAndUpdateProgress = (output) => {
         // Parse standard yt-dlp download progress (format: "[download]  XX.X% of YY.YMiB at ZZ.ZZMiB/s ETA MM:SS")
-        const downloadMatch = output.match(/\[download\]\s+(\d+\.?\d*)%\s+of\s+([\d.]+)(\w+)\s+at\s+([\d.]+)(\w+\/s)/);
+        const downloadMatch = output.match(YTDLP_DOWNLOAD_REGEX);
         if (downloadMatch) {
           const downloadPercent = parseFloat(downloadMatch[1]);
           const fileSize = parseFloat(downloadMatch[2]);
@@ -737,7 +741,7 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
           const speedUnit = downloadMatch[5];
           
           // Parse ETA if present
-          const etaMatch = output.match(/ETA\s+(\d+):(\d+)/);
+          const etaMatch = output.match(YTDLP_ETA_REGEX);
           let etaSeconds = null;
           if (etaMatch) {
             etaSeconds = parseInt(etaMatch[1]) * 60 + parseInt(etaMatch[2]);
@@ -759,7 +763,7 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
         }
         
         // Fallback: simpler percentage-only match
-        const simpleMatch = output.match(/\[download\]\s+(\d+\.?\d*)%/);
+        const simpleMatch = output.match(YTDLP_PERCENT_REGEX);
         if (simpleMatch) {
           const downloadPercent = parseFloat(simpleMatch[1]);
           if (downloadPercent > lastProgress) {
@@ -774,7 +778,7 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
         }
 
         // Parse FFmpeg progress when using --download-sections (format: "time=00:05:30.00")
-        const timeMatch = output.match(/time=(\d+):(\d+):(\d+)/);
+        const timeMatch = output.match(FFMPEG_TIME_REGEX);
         if (timeMatch && targetDuration > 0) {
           const hours = parseInt(timeMatch[1]);
           const minutes = parseInt(timeMatch[2]);
@@ -795,7 +799,7 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
         }
 
         // Parse frame-based progress (format: "frame= 1234")
-        const frameMatch = output.match(/frame=\s*(\d+)/);
+        const frameMatch = output.match(FFMPEG_FRAME_REGEX);
         if (frameMatch) {
           const frames = parseInt(frameMatch[1]);
           if (frames % 500 === 0) { // Update every 500 frames
@@ -807,18 +811,32 @@ async function processYouTubeDownload(jobId, url, startTime, endTime, quality, i
         }
       };
 
-      ytdlp.stdout.on('data', (data) => {
-        const output = data.toString();
-        console.log('yt-dlp stdout:', output.trim());
-        parseAndUpdateProgress(output);
-      });
+      // A data chunk can hold several lines (yt-dlp --newline, ffmpeg's
+      // \r-separated progress); log everything except progress lines and
+      // update progress from the last progress line in the chunk
+      const handleOutput = (streamName, data) => {
+        let lastProgressLine = null;
 
-      ytdlp.stderr.on('data', (data) => {
-        const output = data.toString();
-        console.log('yt-dlp stderr:', output.trim());
-        // FFmpeg progress often goes to stderr
-        parseAndUpdateProgress(output);
-      });
+        for (const rawLine of data.toString().split(OUTPUT_LINE_SPLIT_REGEX)) {
+          const line = rawLine.trim();
+          if (!line) continue;
+
+          if (!YTDLP_ALERT_REGEX.test(line) && isProgressLine(line)) {
+            lastProgressLine = line;
+          } else {
+            console.log(`yt-dlp ${streamName}:`, line);
+          }
+        }
+
+        if (lastProgressLine) {
+          parseAndUpdateProgress(lastProgressLine);
+        }
+      };
+
+      ytdlp.stdout.on('data', (data) => handleOutput('stdout', data));
+
+      // FFmpeg progress often goes to stderr
+      ytdlp.stderr.on('data', (data) => handleOutput('stderr', data));
 
       ytdlp.on('close', (code) => {
         if (code === 0) {
@@ -893,13 +911,9 @@ async function splitYouTubeIntoSegments(jobId, videoPath, totalDuration, interva
       message: 'Preparing segments'
     });
 
-    // Calculate cut points
-    const cutPoints = [];
-    let position = intervalLength;
-    while (position < totalDuration) {
-      cutPoints.push(position);
-      position += intervalLength;
-    }
+    // Calculate cut points at each interval multiple strictly inside the video
+    const cutCount = Math.max(0, Math.ceil(totalDuration / intervalLength) - 1);
+    const cutPoints = Array.from({ length: cutCount }, (_, i) => (i + 1) * intervalLength);
 
     const sortedCuts = [0, ...cutPoints, totalDuration];
     const segmentCount = sortedCuts.length - 1;
@@ -1011,6 +1025,26 @@ function formatTimeDisplay(seconds) {
   return `${mins}:${String(secs).padStart(2, '0')}`;
 }
 
+// Helper function to detect yt-dlp/ffmpeg progress output lines
+function isProgressLine(line) {
+  return YTDLP_PERCENT_REGEX.test(line) || FFMPEG_TIME_REGEX.test(line) || FFMPEG_FRAME_REGEX.test(line);
+}
+
+// Helper function to convert an ffmpeg timemark ("00:01:30.00") to seconds
+function parseTimemark(timemark) {
+  const match = FFMPEG_TIMEMARK_REGEX.exec(timemark);
+  if (!match) return null;
+  return parseInt(match[1]) * 3600 + parseInt(match[2]) * 60 + parseFloat(match[3]);
+}
+
+// Helper function to convert ffprobe frame rates like "30000/1001" to a number
+function parseFrameRate(rate) {
+  if (!rate) return undefined;
+  const [num, den = 1] = rate.split('/').map(Number);
+  const fps = num / den;
+  return Number.isFinite(fps) ? fps : undefined;
+}
+
 // Delete video file
 export const deleteVideo = async (req, res) => {
   try {
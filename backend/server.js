@@ -38,6 +38,25 @@ const PORT = 3001;
 app.use(cors());
 app.use(express.json());
 
+// Log slow API requests so latency regressions show up in the server output
+const SLOW_REQUEST_MS = 1000;
+// Uploads and Gemini comparisons routinely take far longer, so skip them
+const SLOW_REQUEST_EXCLUDED_PATHS = ['/video/upload', '/compare/analyze', '/compare/batch'];
+app.use('/api', (req, res, next) => {
+  if (SLOW_REQUEST_EXCLUDED_PATHS.some(prefix => req.path.startsWith(prefix))) {
+    return next();
+  }
+
+  const start = performance.now();
+  res.on('finish', () => {
+    const duration = performance.now() - start;
+    if (duration >= SLOW_REQUEST_MS) {
+      console.log(`🐢 ${req.method} ${req.originalUrl} -> ${res.statusCode} in ${Math.round(duration)}ms`);
+    }
+  });
+  next();
+});
+
 // Ensure required directories exist
 const uploadsDir = path.join(__dirname, '..', 'uploads');
 const outputsDir = path.join(__dirname, '..', 'outputs');
@@ -83,7 +102,9 @@ const videoFilter = (req, file, cb) => {
   if (mimetype && extname) {
     return cb(null, true);
   }
-  cb(new Error('Only video files are allowed'));
+  const error = new Error('Only video files are allowed');
+  error.status = 400;
+  cb(error);
 };
 
 const upload = multer({
@@ -109,6 +130,19 @@ app.get('/health', (req, res) => {
   res.json({ status: 'ok', message: 'Battleborn Video Splitter API' });
 });
 
+// Global error handler for errors passed to next() (multer limits and file
+// filter rejections, malformed JSON bodies) so they return JSON, not HTML
+app.use((err, req, res, next) => {
+  if (res.headersSent) {
+    return next(err);
+  }
+
+  const status = err instanceof multer.MulterError ? 400 : (err.status || err.statusCode || 500);
+
+  console.error(`Request error (${req.method} ${req.originalUrl}):`, err.message);
+  res.status(status).json({ error: err.message || 'Internal server error' });
+});
+
 app.listen(PORT, () => {
   console.log(`Server running on http://localhost:${PORT}`);
 });
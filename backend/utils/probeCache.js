@@ -0,0 +1,47 @@
+// In-memory cache of ffprobe metadata keyed by file path
+// Comparison segments are validated again each time a pair or batch is
+// re-run; entries are reused until the file's size or modification time changes
+
+import fs from 'fs/promises';
+import ffmpeg from 'fluent-ffmpeg';
+
+class ProbeCache {
+  constructor() {
+    this.entries = new Map();
+  }
+
+  async probe(filePath) {
+    const stats = await fs.stat(filePath);
+    const cached = this.entries.get(filePath);
+
+    if (cached && cached.mtimeMs === stats.mtimeMs && cached.size === stats.size) {
+      return cached.metadata;
+    }
+
+    const metadata = await new Promise((resolve, reject) => {
+      ffmpeg.ffprobe(filePath, (err, data) => {
+        if (err) reject(err);
+        else resolve(data);
+      });
+    });
+
+    this.entries.set(filePath, {
+      mtimeMs: stats.mtimeMs,
+      size: stats.size,
+      metadata
+    });
+
+    return metadata;
+  }
+
+  async getDuration(filePath) {
+    const metadata = await this.probe(filePath);
+    return metadata.format.duration;
+  }
+
+  invalidate(filePath) {
+    this.entries.delete(filePath);
+  }
+}
+
+export default new ProbeCache();